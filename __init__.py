@@ -1 +1 @@
-from .client_synergy import Stream, Protocol, ProtocolMsg, MessageHandler, run
+from .client_synergy import Stream, Protocol, ProtocolMsg, MessageHandler, UnknownMessageError, run
@@ -21,11 +21,32 @@ Protocol -- parsing messages from bytes to list and then formatting them back fr
 There is also a ProtocolMsg static class that contains all message formats
 """
 
+import functools
+import logging
 import socket
+import selectors
 import time
 import struct
+import sys
 import re
 
+log = logging.getLogger(__name__)
+
+# Struct format chars for the integer widths used in ProtocolMsg
+_INT_CODE = {1: 'b', 2: 'h', 4: 'i'}
+# Prebuilt big-endian packer for sizes and lengths
+_S_I = struct.Struct('>i')
+# Initial size of the receive buffer of Stream
+_RECV_BUF_SIZE = 65536
+# Stream stops taking already arrived data once it has that much buffered
+_MAX_DRAIN = 4 * _RECV_BUF_SIZE
+# Larger messages are treated as a corrupt stream
+_MAX_MSG_SIZE = 16 * 1024 * 1024
+# Option name, value pair of the %I vector
+_S_OPTION = struct.Struct('>4si')
+# Format field with optional width, e.g. '%2i' or '%s'
+_FIELD_RE = re.compile(r'%(\d*)(.)')
+
 # First message from server (Synergy 1.6):
 # b'\x00\x00\x00\x0bSynergy\x00\x01\x00\x06'
 
@@ -48,16 +69,16 @@ def main():
     # test_parser()
     # return
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     run()
 
 def run(stream=None, protocol=None, handler=None):
+    host = None
     if stream is None:
         host = socket.gethostname()
         # host = '192.168.162.201'
         port = 24800
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
-        stream = Stream(sock)
+        stream = connect(host, port)
 
     if protocol is None:
         protocol = Protocol()
@@ -65,34 +86,62 @@ def run(stream=None, protocol=None, handler=None):
     if handler is None:
         handler = MessageHandler(stream, protocol)
 
+    # Keepalive has no arguments and is recognized without parsing,
+    # the reply still comes from the handler
+    keep_alive      = ProtocolMsg.kMsgCKeepAlive.encode('ascii')
+    keep_alive_info = ['kMsgCKeepAlive']
+
     try:
         while True:
-            msg = stream.read()
-            if msg is None:
+            # All messages that have already arrived are handled as a batch,
+            # so that bursts (e.g. mouse moves) can be coalesced
+            msgs   = stream.read_messages()
+            closed = msgs is None
+            if closed: msgs = []
+
+            # Traffic is logged only on demand, checked once per batch
+            debug = log.isEnabledFor(logging.DEBUG)
+
+            msg_infos = []
+            for msg in msgs:
+                if msg == keep_alive:
+                    msg_infos.append(keep_alive_info)
+                    continue
+                try:
+                    msg_info = protocol.parse(msg)
+                except UnknownMessageError:
+                    # E.g. message from a newer protocol version
+                    log.warning('Skipping unknown message %r', bytes(msg))
+                    continue
+                except Exception:
+                    raise RuntimeError('error parsing', bytes(msg))
+
+                # [msg_name, *msg_args] 
+                if debug and msg_info[0] != 'kMsgDMouseMove':
+                    log.debug('From server: %r %r', bytes(msg), msg_info)
+                msg_infos.append(msg_info)
+
+            for i, msg_info in enumerate(msg_infos):
+                # Mouse move is absolute, so when several moves arrive in a row
+                # only the latest one has to be performed
+                if msg_info[0] == 'kMsgDMouseMove' and i + 1 < len(msg_infos) \
+                   and msg_infos[i + 1][0] == 'kMsgDMouseMove': continue
+
+                response = handler.handle(msg_info)
+
+                if response is None: continue
+
+                if debug: log.debug('To   server: %r', response)
+                stream.send(response)
+            # Responses to the whole batch are sent together
+            stream.flush()
+
+            if closed:
+                if host is None: break
                 # Connection closed, trying to reconnect
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((host, port))
-                stream = Stream(sock)
-
-            if not msg.startswith(b'DMMV'):
-                print('From server:', msg)
-
-            try:
-                msg_info = protocol.parse(msg)
-            except:
-                raise RuntimeError('error parsing', msg)
-
-            # [msg_name, *msg_args] 
-            if msg_info[0] != 'kMsgDMouseMove':
-                print('From server:', msg)
-                print('            ', msg_info)
-            
-            response = handler.handle(msg_info)
-
-            if response == None: continue
-
-            print('To   server:', response)
-            stream.send(response)
+                stream.close()
+                stream = connect(host, port)
+                handler.stream = stream
     finally:
         stream.close()
 
@@ -100,36 +149,62 @@ def run(stream=None, protocol=None, handler=None):
 
 class MessageHandler:
     """A class to handle (normally by responding to) various received synergy messages
-    Message handler methods are found automatically by name
-    'on_' + msg_name[4:].lower()
+    Message handler methods are found automatically by name when the handler
+    is created, see handler_name()
     So that 'kMsgHello' message is handled by 'on_hello' method,
     'kMsgCEnter' is handled by 'on_c_enter' method
     """
+    __slots__ = ('stream', 'protocol', 'client_name',
+                 '_resp_hello_back', '_resp_keep_alive', '_resp_info',
+                 '_keyboard', '_key_code', '_mouse', '_buttons', '_mouse_move',
+                 '_dispatch')
+
     def __init__(self, stream, protocol, client_name='tablet'):
         self.stream   = stream
         self.protocol = protocol
 
         self.client_name = client_name
 
-    def get_handler(self, msg_name):
-        """See class documentation for details on method_name
-        """
-        # Convert method names of type kMsgDInfo to 'on_d_info'
-        msg_name_short = msg_name[4:]
-        method_name    = re.sub('[A-Z]', lambda m: '_' + m.group(0).lower(),
-                                msg_name_short)
-        method_name    = 'on' + method_name
-        try:
-            return self.__getattribute__(method_name)
-        except AttributeError:
-            raise KeyError('Could not find handler for', msg_name)
+        # Responses that don't depend on the received message are formatted once
+        self._resp_hello_back = self.protocol.format(ProtocolMsg.kMsgHelloBack,
+                                                     1, 6, self.client_name)
+        self._resp_keep_alive = self.protocol.format(ProtocolMsg.kMsgCKeepAlive)
+        # (width, height) -> kMsgDInfo response
+        self._resp_info       = {}
+
+        # Input backends are imported once here instead of in every handler
+        import pynput
+        import mouse
+        self._keyboard   = pynput.keyboard.Controller()
+        # The same keys are pressed over and over, reuse their KeyCode objects
+        self._key_code   = functools.lru_cache(maxsize=512)(pynput.keyboard.KeyCode)
+        self._mouse      = pynput.mouse.Controller()
+        # Synergy ButtonID -> pynput button
+        self._buttons    = {
+            1: pynput.mouse.Button.left,
+            2: pynput.mouse.Button.middle,
+            3: pynput.mouse.Button.right,
+        }
+        self._mouse_move = mouse.move
+
+        # Resolve all handlers once, so that handle() is a single dict lookup
+        self._dispatch = {}
+        for msg_name in PROTOCOL_MSG_TYPES:
+            method = getattr(self, handler_name(msg_name), None)
+            if method is not None:
+                self._dispatch[msg_name] = method
 
     def handle(self, msg_info):
-        msg_name = msg_info[0]
-        method = self.get_handler(msg_name)
+        """
+        @return response message bytes or None if there is no response
+        """
+        method = self._dispatch.get(msg_info[0])
+        if method is None:
+            raise KeyError('Could not find handler for', msg_info[0])
         try:
             return method(msg_info)
-        except:
+        except Exception:
+            # SystemExit from on_c_close() is let through
             raise RuntimeError('Error handling message', msg_info)
 
 
@@ -141,11 +216,9 @@ class MessageHandler:
         """
         # Expected message: b'Synergy\x00\x01\x00\x06'
         ver_maj, ver_min = msg_info[1:]
-        print(f'Connected to server v{ver_maj}.{ver_min}')
-        ver_maj, ver_min = 1,6
-        return self.protocol.format(ProtocolMsg.kMsgHelloBack,
-                                    ver_maj, ver_min,
-                                    self.client_name)
+        log.info('Connected to server v%d.%d', ver_maj, ver_min)
+        # Client always responds with v1.6
+        return self._resp_hello_back
 
     def on_hello_back(self, msg_info):
         """ respond to hello from server;  secondary -> primary
@@ -162,7 +235,7 @@ class MessageHandler:
         """ close connection;  primary -> secondary
         """
         self.stream.close()
-        print('Got CBYE from the server')
+        log.info('Got CBYE from the server')
         exit(0)
 
     def on_c_enter(self, msg_info):
@@ -178,7 +251,7 @@ class MessageHandler:
         the secondary screen should adjust its toggle modifiers to reflect that state.
         """
         x, y, seq_num, mod_keymask = msg_info[1:]
-        print(msg_info)
+        log.info('Entering screen at (%d, %d)', x, y)
 
     def on_c_leave(self, msg_info):
         """ leave screen:  primary -> secondary
@@ -189,7 +262,7 @@ class MessageHandler:
         number) and that were grabbed or have changed since the
         last leave.
         """
-        print(msg_info)
+        log.info('Leaving screen')
 
     def on_c_clipboard(self, msg_info):
         """ grab clipboard:  primary <-> secondary
@@ -208,7 +281,7 @@ class MessageHandler:
         """ reset options:  primary -> secondary
         client should reset all of its options to their defaults.
         """
-        print('TODO: reset options to defaults')
+        log.info('TODO: reset options to defaults')
 
     def on_c_info_ack(self, msg_info):
         """ resolution change acknowledgment:  primary -> secondary
@@ -228,7 +301,7 @@ class MessageHandler:
         defined by an option.
         """
         # Keepalive packet
-        return self.protocol.format(ProtocolMsg.kMsgCKeepAlive)
+        return self._resp_keep_alive
 
 
     def on_d_key_down_lang(self, msg_info):
@@ -251,20 +324,18 @@ class MessageHandler:
         languageCode is parameter which helps client to react on unknwon
         language letters
         """
-        import pynput
-        keyboard = pynput.keyboard.Controller()
         key_id, key_mask, key_button = msg_info[1:]
 
         if key_id < 0:
             # Not sure why additional 0x1000 is necessary
             key_id +=  0xffff + 0x1000 + 1
-            key     = pynput.keyboard.KeyCode(key_id)
+            key     = self._key_code(key_id)
         else:
             key_id  = button_to_keysym(key_button)
-            key     = pynput.keyboard.KeyCode(key_id)
+            key     = self._key_code(key_id)
             # key     = chr(key_id)
-        print(key)
-        keyboard.press(key)
+        log.debug('Key down: %s', key)
+        self._keyboard.press(key)
 
     def on_d_key_down1_0(self, msg_info):
         """ key pressed 1.0:  same as above but without KeyButton
@@ -284,18 +355,16 @@ class MessageHandler:
         """ key released:  primary -> secondary
         $1 = KeyID, $2 = KeyModifierMask, $3 = KeyButton
         """
-        import pynput
-        keyboard = pynput.keyboard.Controller()
         key_id, key_mask, key_button = msg_info[1:]
         if key_id < 0:
             # Not sure why additional 0x1000 is necessary
             key_id +=  0xffff + 0x1000 + 1
-            key     = pynput.keyboard.KeyCode(key_id)
+            key     = self._key_code(key_id)
         else:
             # key     = chr(key_id)
             key_id  = button_to_keysym(key_button)
-            key     = pynput.keyboard.KeyCode(key_id)
-        keyboard.release(key)
+            key     = self._key_code(key_id)
+        self._keyboard.release(key)
 
     def on_d_key_up1_0(self, msg_info):
         """ key released 1.0:  same as above but without KeyButton
@@ -306,31 +375,24 @@ class MessageHandler:
         $1 = ButtonID
         """
         button_id = msg_info[1]
-        import pynput
-        mouse = pynput.mouse.Controller()
-        if button_id == 1: mouse.press(pynput.mouse.Button.left)
-        if button_id == 2: mouse.press(pynput.mouse.Button.middle)
-        if button_id == 3: mouse.press(pynput.mouse.Button.right)
+        button = self._buttons.get(button_id)
+        if button is not None: self._mouse.press(button)
 
     def on_d_mouse_up(self, msg_info):
         """ mouse button released:  primary -> secondary
         $1 = ButtonID
         """
         button_id = msg_info[1]
-        import pynput
-        mouse = pynput.mouse.Controller()
-        if button_id == 1: mouse.release(pynput.mouse.Button.left)
-        if button_id == 2: mouse.release(pynput.mouse.Button.middle)
-        if button_id == 3: mouse.release(pynput.mouse.Button.right)
+        button = self._buttons.get(button_id)
+        if button is not None: self._mouse.release(button)
 
     def on_d_mouse_move(self, msg_info):
         """ mouse moved:  primary -> secondary
         $1 = x, $2 = y.  x,y are absolute screen coordinates.
         """
-        import mouse
         abs_x, abs_y = msg_info[1:]
-        mouse.move(abs_x, abs_y)
-        # print(msg_info)
+        self._mouse_move(abs_x, abs_y)
+        # log.debug('%s', msg_info)
 
     def on_d_mouse_rel_move(self, msg_info):
         """ relative mouse move:  primary -> secondary
@@ -357,7 +419,7 @@ class MessageHandler:
         identifier.
         """
         clipb_id, seq_num, mark, data = msg_info[1:]
-        print(msg_info)
+        log.debug('Clipboard: %r', msg_info)
 
     def on_d_info(self, msg_info):
         """ client data:  secondary -> primary
@@ -381,8 +443,7 @@ class MessageHandler:
         client should set the given option/value pairs.  $1 = option/value
         pairs.
         """
-        print('TODO: set options')
-        print('DSOP', msg_info)
+        log.info('TODO: set options %s', msg_info[1])
 
     def on_d_file_transfer(self, msg_info):
         """ file data:  primary <-> secondary
@@ -414,10 +475,13 @@ class MessageHandler:
         """ query screen info:  primary -> secondary
         client should reply with a kMsgDInfo.
         """
-        print(f'Informing about display info')
+        log.info('Informing about display info')
         from screeninfo import get_monitors
         # TODO: Use better way to work with multiple monitors
         m = get_monitors()[0]
+        # Response only changes together with the screen resolution
+        response = self._resp_info.get((m.width, m.height))
+        if response is not None: return response
         values = [
           0,             # leftmost pixel x
           0,             # topmost pixel y
@@ -427,7 +491,9 @@ class MessageHandler:
           m.width  // 2, # mouse_x
           m.height // 2, # mouse_y
         ]
-        return self.protocol.format(ProtocolMsg.kMsgDInfo, *values)
+        response = self.protocol.format(ProtocolMsg.kMsgDInfo, *values)
+        self._resp_info[(m.width, m.height)] = response
+        return response
 
     def on_e_incompatible(self, msg_info):
         """ incompatible versions:  primary -> secondary
@@ -456,157 +522,290 @@ class MessageHandler:
 ################################################
 
 class Stream:
+    __slots__ = ('sock', '_buf', '_fill', '_out', '_selector')
+
     def __init__(self, sock):
         """
         @param sock  Socket for the connection to synergy server
         """
-        self.sock = sock
-    def read(self):
+        self.sock  = sock
+        # Received bytes that are not yet returned as messages, _buf[:_fill]
+        self._buf  = bytearray(_RECV_BUF_SIZE)
+        self._fill = 0
+        # Messages queued by send()
+        self._out  = bytearray()
+        # Used to check whether more data has arrived
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def read_messages(self):
+        """Receive all messages that have already arrived,
+        waiting until there is at least one.
+        A single recv normally brings several messages (e.g. mouse moves)
+        and TCP can split a message in several segments, so received data
+        is buffered and split into messages here.
+        @return list of memoryviews of messages without the size prefix
+                or None if the connection was closed
+        """
+        while True:
+            bounds = []
+            start  = 0
+            while self._fill - start >= 4:
+                end = start + 4 + self._msg_size(start)
+                if end > self._fill: break
+                bounds.append((start + 4, end))
+                start = end
+            if bounds:
+                # Complete messages are copied once, together, and returned
+                # as views, so that they stay valid when the buffer is reused
+                with memoryview(self._buf) as view:
+                    data = memoryview(bytes(view[:start]))
+                # Move the incomplete message to the beginning of the buffer
+                self._buf[:self._fill - start] = self._buf[start:self._fill]
+                self._fill -= start
+                # Don't keep the memory taken by a large message or burst
+                if self._fill < _RECV_BUF_SIZE < len(self._buf):
+                    del self._buf[_RECV_BUF_SIZE:]
+                return [data[msg_start:msg_end] for msg_start, msg_end in bounds]
+
+            if self._fill >= 4:
+                # Make sure that the incomplete message fits into the buffer
+                size = 4 + self._msg_size(0)
+                if size > len(self._buf):
+                    self._buf.extend(bytes(size - len(self._buf)))
+            if self._recv() == 0:
+                if self._fill == 0: return None
+                raise ConnectionError('Connection closed while reading message')
+            # Take everything else that has already arrived without waiting,
+            # closed connection is detected by the next call.
+            # Draining is limited, so that replies are not delayed for long
+            # under continuous traffic
+            while self._fill < _MAX_DRAIN and self._selector.select(0):
+                if self._fill == len(self._buf):
+                    self._buf.extend(bytes(len(self._buf)))
+                if self._recv() == 0: break
+
+    def _msg_size(self, start):
+        """Read the size of the message that begins at start of the buffer
+        """
         # Packet size is sent as big-endian int
-        size       = self.sock.recv(4)
-        if len(size) == 0: return None
-        size       = struct.unpack('>i', size)[0]
-        to_receive = size
-        #
-        data = b''
-        while to_receive > 0:
-            data += self.sock.recv(to_receive)
-            to_receive -= len(data)
-        return data
+        size = _S_I.unpack_from(self._buf, start)[0]
+        if size < 0 or size > _MAX_MSG_SIZE:
+            raise ConnectionError('Invalid message size %d' % size)
+        return size
+
+    def _recv(self):
+        """Receive available data into the free part of the buffer
+        @return number of received bytes, 0 if the connection was closed
+        """
+        with memoryview(self._buf) as view:
+            n = self.sock.recv_into(view[self._fill:])
+        self._fill += n
+        return n
+
     def send(self, data):
+        """Queue the message, it is actually sent by flush()
+        """
         # Packet size is sent as big-endian int
-        size = len(data)
-        size = struct.pack('>i', size)
-        #
-        print(size + data)
-        self.sock.sendall(size + data)
+        self._out += _S_I.pack(len(data))
+        self._out += data
+
+    def flush(self):
+        """Send all queued messages with a single call
+        """
+        if not self._out: return
+        self.sock.sendall(self._out)
+        self._out.clear()
 
     def close(self):
+        self._selector.close()
         self.sock.close()
 
+class UnknownMessageError(ValueError):
+    """Message identifier doesn't match any of ProtocolMsg formats
+    """
+
 class Protocol:
     """The class to parse and generate messages supported by Synergy v1.11 protocol
     """
+    __slots__ = ('msg_types', '_compiled', '_by_id', '_encoders')
+
     def __init__(self):
-        self.msg_types = {
-            msg_name : msg_fmt for msg_name, msg_fmt in vars(ProtocolMsg).items()
-            if msg_name.startswith('kMsg')
+        # Tables are read-only and shared by all instances, see _build_tables()
+        self.msg_types = PROTOCOL_MSG_TYPES
+        self._compiled, self._by_id, self._encoders = _PROTOCOL_TABLES
+
+    @staticmethod
+    def _build_tables(msg_types):
+        """Prepare everything needed to parse and format messages of msg_types
+        @return (compiled, by_id, encoders)
+        """
+        # Message formats are interpreted only once, see _compile()
+        compiled = {
+            msg_fmt : Protocol._compile(msg_fmt) for msg_fmt in msg_types.values()
         }
-    def __read_int(self, buf):
-        ret = 0
-        while buf[0] in '0123456789':
-            ret = ret * 10 + int(buf[0])
-            buf = buf[1:]
-            if len(buf) == 0: return (None, None)
-        return (ret, buf)
-
-    def __unpack_int(self, buf, width):
-        """Unpack big-endian integer of specified width
-        """
-        if width == 1: struct_fmt = '>b'
-        if width == 2: struct_fmt = '>h'
-        if width == 4: struct_fmt = '>i'
-        val_buf = buf[:width]
-        buf     = buf[width:]
-        val = struct.unpack(struct_fmt, val_buf)[0]
-        return (val, buf)
+        # Most messages (including the frequent mouse move and keepalive)
+        # have fixed layout and get specialized functions, see _specialize()
+        #
+        # First 4 bytes always serve as a message identifier, so parse() needs
+        # a single lookup of (msg_name, parse ops, decode or None) by identifier.
+        # Some identifiers are shared (e.g. kMsgDKeyDown and kMsgDKeyDown1_0),
+        # in that case the first declared message format is used.
+        by_id    = {}
+        encoders = {}
+        for msg_name, msg_fmt in msg_types.items():
+            ops     = compiled[msg_fmt]
+            special = Protocol._specialize(msg_name, ops)
+            decode  = None
+            if special is not None:
+                decode, encode = special
+                encoders[msg_fmt] = encode
+            # Identifier is matched by the lookup itself, so parsing of the
+            # fields starts right after it
+            lit_rest  = ops[0][1][4:]
+            parse_ops = (('lit', lit_rest),) + ops[1:] if lit_rest else ops[1:]
+            by_id.setdefault(msg_fmt[:4].encode('ascii'),
+                             (msg_name, parse_ops, decode))
+        return (compiled, by_id, encoders)
+
+    @staticmethod
+    def _specialize(msg_name, ops):
+        """Generate decoder and encoder for the format that is a literal followed
+        only by integers (e.g. "DMMV%2i%2i"). All integers are handled by
+        a single struct call instead of going through _parse() and format()
+        @return (decode, encode) or None if the format has other fields
+                decode(msg_bytes) -> [msg_name, *msg_args]
+                encode(*msg_args) -> message bytes
+        """
+        if ops[0][0] != 'lit' or len(ops) > 2: return None
+        if len(ops) == 2 and ops[1][0] != 'i': return None
+        prefix = ops[0][1]
+        offset = len(prefix)
+        fields = ops[1][2] if len(ops) == 2 else struct.Struct('>')
+        unpack_from = fields.unpack_from
+        pack        = fields.pack
+        def decode(msg_bytes):
+            # First 4 bytes are already matched by parse()
+            if offset > 4 and msg_bytes[:offset] != prefix:
+                raise ValueError('Could not parse message', msg_bytes)
+            return [msg_name, *unpack_from(msg_bytes, offset)]
+        def encode(*args):
+            return prefix + pack(*args)
+        return (decode, encode)
+
+    @staticmethod
+    def _compile(fmt):
+        """Convert format string to the tuple of operations:
+        ('lit', b'DMMV')         -- literal bytes (consecutive chars are merged)
+        ('i', count, packer)     -- consecutive big-endian integers
+        ('I', width)             -- vector of name, value pairs
+        ('s',)                   -- string prefixed with its length
+        """
+        ops = []
+        pos = 0
+        for field in _FIELD_RE.finditer(fmt):
+            # Literal chars between the fields
+            if field.start() > pos:
+                ops.append(('lit', fmt[pos:field.start()].encode('ascii')))
+            pos    = field.end()
+            width  = int(field.group(1) or 0)
+            fmt_id = field.group(2)
+            if   fmt_id == 'i':
+                if width == 0: raise ValueError('Width should be non-zero')
+                if width not in _INT_CODE:
+                    raise KeyError('Width %d not supported' % width)
+                # Consecutive integers are packed by a single Struct
+                codes = ''
+                if ops and ops[-1][0] == 'i': codes = ops.pop()[2].format[1:]
+                codes += _INT_CODE[width]
+                ops.append(('i', len(codes), struct.Struct('>' + codes)))
+            elif fmt_id == 'I':
+                if width == 0: raise ValueError('Width should be non-zero')
+                ops.append(('I', width))
+            elif fmt_id == 's':
+                ops.append(('s',))
+            else:
+                raise KeyError('Format %s not supported' % fmt_id)
+        if pos < len(fmt):
+            ops.append(('lit', fmt[pos:].encode('ascii')))
+        return tuple(ops)
 
     def parse(self, msg_bytes):
         """Parse message bytes to determine the received Synergy message.
         """
-        for msg_name, msg_fmt in self.msg_types.items():
-            # First 4 bytes always serve as a message identifier
-            msg_identifier = msg_fmt[:4].encode('ascii')
-            if msg_bytes[:4] != msg_identifier: continue
-
-            return [msg_name] + self._parse(msg_fmt, msg_bytes)
-        raise ValueError('Could not parse message', msg_bytes)
+        entry = self._by_id.get(bytes(msg_bytes[:4]))
+        if entry is None:
+            raise UnknownMessageError('Unknown message', bytes(msg_bytes))
+        msg_name, ops, decode = entry
+        if decode is not None: return decode(msg_bytes)
+        # Fields are read from the view without copying the message
+        return [msg_name] + self._parse(ops, memoryview(msg_bytes), 4)
 
     def format(self, fmt, *args):
         """Generate synergy command
         @return message bytes
         """
-        msg = b''
-        while len(fmt) > 0:
-            if fmt[0] == '%':
-                fmt = fmt[1:]
-                # if len(fmt) == 0: return None
-                width, fmt = self.__read_int(fmt)
-                # if width is None: return None
-                # if len(fmt) == 0: return None
-                fmt_id = fmt[0]
-                fmt = fmt[1:]
-                if   fmt_id == 'i':
-                    if width == 0: raise ValueError('Width should be non-zero')
-                    val  = args[0]
-                    args = args[1:]
-                    if width == 1: struct_fmt = '>b'
-                    if width == 2: struct_fmt = '>h'
-                    if width == 4: struct_fmt = '>i'
-                    val_buf = struct.pack(struct_fmt, val)
-                    msg += val_buf
-                elif fmt_id == 's':
-                    val  = args[0].encode('ascii')
-                    args = args[1:]
-                    strlen = struct.pack('>i', len(val))
-                    msg += strlen
-                    msg += val
-                else:
-                    raise KeyError('Format %s not supported' % fmt_id)
+        encode = self._encoders.get(fmt)
+        if encode is not None: return encode(*args)
+        ops = self._compiled.get(fmt)
+        if ops is None: ops = self._compile(fmt)
+        msg = bytearray()
+        for op in ops:
+            if   op[0] == 'lit':
+                msg += op[1]
+            elif op[0] == 'i':
+                msg += op[2].pack(*args[:op[1]])
+                args = args[op[1]:]
+            elif op[0] == 's':
+                val  = args[0].encode('ascii')
+                args = args[1:]
+                # Length is written in place, without packing it separately
+                pos  = len(msg)
+                msg += b'\0\0\0\0'
+                msg += val
+                _S_I.pack_into(msg, pos, len(val))
             else:
-                msg += fmt[0].encode('ascii')
-                fmt = fmt[1:]
-        # while len(fmt) > 0:
+                raise KeyError('Format %s not supported' % op[0])
 
-        return msg
-    def _parse(self, fmt, msg):
+        return bytes(msg)
+    def _parse(self, ops, msg, off=0):
         """Basically simplified version of scanf,
         returns the list of scanned %i arguments
+        @param msg  Message bytes or memoryview of them
+        @param off  Offset in msg to start parsing from
         """
         ret = []
-        while len(fmt) > 0:
-            if fmt[0] == '%':
-                fmt = fmt[1:]
-                # if len(fmt) == 0: return None
-                width, fmt = self.__read_int(fmt)
-                # if width is None: return None
-                # if len(fmt) == 0: return None
-                fmt_id = fmt[0]
-                fmt = fmt[1:]
-                if   fmt_id == 'i':
-                    if width == 0: raise ValueError('Width should be non-zero')
-                    val, msg = self.__unpack_int(msg, width)
-                    ret.append(val)
-                elif fmt_id == 'I':
-                    # name, value pairs
-                    if width == 0: raise ValueError('Width should be non-zero')
-                    vec_vals     = []
-                    vec_len, msg = self.__unpack_int(msg, 4)
-                    for i in range(vec_len):
-                        if i % 2 == 0:
-                            val = msg[:4].decode('ascii')
-                            msg = msg[4:]
-                        else:
-                            val, msg = self.__unpack_int(msg, 4)
-                        vec_vals.append(val)
-                    ret.append(vec_vals)
-                elif fmt_id == 's':
-                    # It seems that sometimes string argument can be skipeed
-                    if len(msg) == 0 and len(fmt) == 0: continue
-                    strlen, msg = self.__unpack_int(msg, 4)
-                    # TODO: Some clipboard contents crashed during parsing when using UTF8
-                    content = msg[:strlen] # .decode('utf8')
-                    ret.append(content)
-                    msg = msg[strlen:]
-                else:
-                    raise KeyError('Format %s not supported' % fmt_id)
-
-            elif fmt[0] != chr(msg[0]):
+        for op in ops:
+            if   op[0] == 'lit':
                 # If some plain character doesn't match, terminate processing
-                return None
-            else:
-                fmt = fmt[1:]
-                msg = msg[1:]
+                if msg[off:off + len(op[1])] != op[1]: return None
+                off += len(op[1])
+            elif op[0] == 'i':
+                ret.extend(op[2].unpack_from(msg, off))
+                off += op[2].size
+            elif op[0] == 'I':
+                # name, value pairs
+                vec_vals = []
+                vec_len  = _S_I.unpack_from(msg, off)[0]
+                off     += 4
+                pairs    = msg[off:off + vec_len // 2 * _S_OPTION.size]
+                for name, val in _S_OPTION.iter_unpack(pairs):
+                    vec_vals.append(name.decode('ascii'))
+                    vec_vals.append(val)
+                off += len(pairs)
+                if vec_len % 2:
+                    vec_vals.append(bytes(msg[off:off + 4]).decode('ascii'))
+                    off += 4
+                ret.append(vec_vals)
+            elif op[0] == 's':
+                # It seems that sometimes string argument can be skipeed
+                if len(msg) == off and op is ops[-1]: continue
+                strlen = _S_I.unpack_from(msg, off)[0]
+                off   += 4
+                # TODO: Some clipboard contents crashed during parsing when using UTF8
+                content = bytes(msg[off:off + strlen]) # .decode('utf8')
+                ret.append(content)
+                off += strlen
 
         return ret
 
@@ -783,14 +982,53 @@ class ProtocolMsg:
     # primary should disconnect after sending this message.
     kMsgEBad                     = "EBAD";
 
+# Interned names make comparisons like msg_info[0] != 'kMsgDMouseMove'
+# an identity check
+PROTOCOL_MSG_TYPES = {
+    sys.intern(msg_name) : msg_fmt
+    for msg_name, msg_fmt in vars(ProtocolMsg).items()
+    if msg_name.startswith('kMsg')
+}
+_PROTOCOL_TABLES = Protocol._build_tables(PROTOCOL_MSG_TYPES)
+
 ################################################
 # AUXILLARY FUNCTIONS
 
+def connect(host, port):
+    """Connect to synergy server
+    @return Stream for the new connection
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Buffer sizes have to be set before connecting,
+    # TCP window scale is negotiated during the handshake
+    sock.setsockopt(socket.SOL_SOCKET,  socket.SO_RCVBUF,   1 << 20)
+    sock.setsockopt(socket.SOL_SOCKET,  socket.SO_SNDBUF,   1 << 20)
+    sock.connect((host, port))
+    # Synergy messages are tiny (mouse move is 12 bytes on the wire), disable
+    # Nagle's algorithm so that responses like keepalive are not delayed
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return Stream(sock)
+
+def handler_name(msg_name):
+    """Convert message names of type kMsgDInfo to 'on_d_info'
+    """
+    return 'on' + ''.join('_' + c.lower() if 'A' <= c <= 'Z' else c
+                          for c in msg_name[4:])
+
+# KeyButton -> keysym, built on the first call of button_to_keysym()
+_KEYSYM_BY_BUTTON = None
+
 def button_to_keysym(btn_id):
-    import pynput
-    keyboard = pynput.keyboard.Controller()
-    key_map = keyboard.keyboard_mapping
-    return [k for (k, v) in key_map.items() if v[0] == btn_id][0]
+    global _KEYSYM_BY_BUTTON
+    if _KEYSYM_BY_BUTTON is None:
+        import pynput
+        keyboard = pynput.keyboard.Controller()
+        key_map  = keyboard.keyboard_mapping
+        # The first keysym found for the button is used
+        _KEYSYM_BY_BUTTON = {}
+        for (k, v) in key_map.items():
+            _KEYSYM_BY_BUTTON.setdefault(v[0], k)
+    return _KEYSYM_BY_BUTTON[btn_id]
 
 ################################################
 